@@ -8,12 +8,34 @@ Instructions:
 4. Start increasing master volume for the stimulus computer or the scanner headphones.
 5. When the participant presses buttons, stop tuning.
 6. Press "space" to close the window.
+
+Calibration:
+Run ``python audio_check.py --calibrate`` with the stimulus computer's output
+routed back into an input (a loopback cable or virtual loopback device) to
+measure output latency and the level of every clip in ``stimuli/audio``.
+Latency is measured through Psychtoolbox's PsychPortAudio with the task's
+latency class by default, or through sounddevice with ``--backend sounddevice``.
+Use ``--loopback-file`` to analyze a prerecorded loopback of the probe instead
+of a live device.
+The resulting profile is written to ``calibration/<hostname>.json`` and is
+used by ``localizer_task.py`` to correct audio onsets and levels.
 """
 
 from __future__ import absolute_import, division, print_function
-import time
+import argparse
+import json
+import os
 import os.path as op
+import platform
 import sys
+import threading
+import time
+from datetime import datetime
+from glob import glob
+
+import numpy as np
+from scipy import signal
+from scipy.io import wavfile
 
 import psychopy
 from psychopy import core, event, visual, sound
@@ -30,6 +52,13 @@ RUN_DURATION = 450  # time for trials in task
 LEAD_IN_DURATION = 6  # fixation before trials
 END_SCREEN_DURATION = 2
 
+# Calibration constants
+PROBE_FILE = op.join('audio', '500Hz_20s.wav')  # relative to stimuli/
+PROBE_DURATION = 0.5  # tone burst, in seconds
+PROBE_PADDING = 0.5  # silence around the tone burst, in seconds
+N_LATENCY_REPEATS = 10
+ONSET_THRESHOLD = 0.1  # fraction of peak amplitude marking an onset
+
 
 def close_on_esc(win):
     """
@@ -90,6 +119,349 @@ def draw(win, stim, duration, clock):
     return response.keys, response.rt
 
 
+def read_wav(filename):
+    """
+    Read a wav file as floats in [-1, 1].
+
+    Returns
+    -------
+    fs : (int)
+        sampling rate in Hertz
+    data : (np.ndarray)
+        samples with shape `(n_samples, n_channels)`
+    """
+    fs, data = wavfile.read(filename)
+    if data.dtype == np.uint8:
+        data = (data.astype(np.float64) - 128) / 128
+    elif np.issubdtype(data.dtype, np.integer):
+        data = data.astype(np.float64) / (np.iinfo(data.dtype).max + 1)
+    return fs, data.reshape(data.shape[0], -1).astype(np.float64)
+
+
+def k_weighting(fs):
+    """
+    Filter coefficients of the ITU-R BS.1770 K-weighting for a sampling rate.
+
+    Returns the high-shelf and high-pass stages as `(b, a)` pairs.
+    """
+    # High-shelf stage
+    f0 = 1681.974450955533
+    gain = 3.999843853973347
+    q = 0.7071752369554196
+    k = np.tan(np.pi * f0 / fs)
+    vh = 10 ** (gain / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = ([(vh + vb * k / q + k * k) / a0,
+              2 * (k * k - vh) / a0,
+              (vh - vb * k / q + k * k) / a0],
+             [1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+    # High-pass stage
+    f0 = 38.13547087602444
+    q = 0.5003270373238773
+    k = np.tan(np.pi * f0 / fs)
+    a0 = 1 + k / q + k * k
+    highpass = ([1, -2, 1],
+                [1, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+    return shelf, highpass
+
+
+def measure_levels(data, fs):
+    """
+    Measure RMS level and integrated loudness of a clip.
+
+    Parameters
+    ----------
+    data : (np.ndarray)
+        samples with shape `(n_samples, n_channels)`
+    fs : (int)
+        sampling rate in Hertz
+
+    Returns
+    -------
+    rms : (float)
+        RMS level in dBFS
+    lufs : (float)
+        gated integrated loudness (ITU-R BS.1770) in LUFS
+    """
+    rms = 10 * np.log10(np.mean(data ** 2))
+
+    shelf, highpass = k_weighting(fs)
+    weighted = signal.lfilter(*shelf, data, axis=0)
+    weighted = signal.lfilter(*highpass, weighted, axis=0)
+
+    # Mean square of 400 ms blocks with 75% overlap, from a cumulative sum
+    block = int(round(0.4 * fs))
+    step = int(round(0.1 * fs))
+    if weighted.shape[0] < block:
+        return rms, -np.inf
+    cumsum = np.vstack((np.zeros((1, weighted.shape[1])),
+                        np.cumsum(weighted ** 2, axis=0)))
+    starts = np.arange(0, weighted.shape[0] - block + 1, step)
+    power = ((cumsum[starts + block] - cumsum[starts]) / block).sum(axis=1)
+
+    with np.errstate(divide='ignore'):
+        loudness = -0.691 + 10 * np.log10(power)
+    gated = power[loudness > -70]  # absolute gate
+    if not gated.size:
+        return rms, -np.inf
+    relative_gate = -0.691 + 10 * np.log10(gated.mean()) - 10
+    gated = power[(loudness > -70) & (loudness > relative_gate)]
+    lufs = -0.691 + 10 * np.log10(gated.mean())
+    return rms, lufs
+
+
+def make_probe(tone, fs):
+    """
+    Make a latency probe from a tone: a tone burst padded by silence.
+    """
+    n_pad = int(PROBE_PADDING * fs)
+    n_tone = int(PROBE_DURATION * fs)
+    burst = tone[:n_tone, 0].copy()
+    # Short ramps keep the burst from clicking
+    ramp = np.hanning(2 * int(0.005 * fs))
+    burst[:ramp.size // 2] *= ramp[:ramp.size // 2]
+    burst[-(ramp.size // 2):] *= ramp[ramp.size // 2:]
+    probe = np.concatenate((np.zeros(n_pad), burst, np.zeros(n_pad)))
+    return probe
+
+
+def find_onset(recording):
+    """Find the sample index of the first sample above the onset threshold."""
+    envelope = np.abs(recording)
+    above = envelope > ONSET_THRESHOLD * envelope.max()
+    if not above.any():
+        raise ValueError('No probe onset found in recording.')
+    return int(np.argmax(above))
+
+
+class PTBLoopback(object):
+    """
+    Loopback through Psychtoolbox's PsychPortAudio, as used by PsychoPy's PTB
+    backend.
+
+    The device's output must be routed back into its input, either with a
+    cable or with a virtual loopback driver. The probe is played and recorded
+    through one full-duplex stream opened with the task's latency class.
+    PsychPortAudio timestamps the first recorded sample and predicts when the
+    first played sample reaches the output, so the latency it reports for
+    that stream is the predicted start time minus when playback was
+    requested.
+
+    Parameters
+    ----------
+    device : (int or None)
+        PsychPortAudio device index for both playback and recording
+    latency_class : (int)
+        PsychPortAudio latency class; the task uses PsychoPy's
+        ``audioLatencyMode`` preference
+    """
+    backend = 'ptb'
+
+    def __init__(self, device=None, latency_class=1):
+        import psychtoolbox
+        from psychtoolbox import audio
+        self._get_secs = psychtoolbox.GetSecs
+        self._audio = audio
+        self.device = device
+        self.latency_class = latency_class
+        self.reported_latency = (0., 0.)
+
+    def playrec(self, probe, fs):
+        """
+        Play `probe` and return the simultaneous recording, with the time
+        from requesting playback to its first sample.
+        """
+        kwargs = {} if self.device is None else {'device_id': self.device}
+        stream = self._audio.Stream(mode=3, latency_class=self.latency_class,
+                                    freq=fs, channels=1, **kwargs)
+        try:
+            stream.fill_buffer(probe.reshape(-1, 1))
+            # Allocate the capture buffer before starting
+            stream.get_audio_data(probe.size / fs + 1)
+            request_time = self._get_secs()
+            start_time = stream.start(when=0, wait_for_start=1)
+            time.sleep(probe.size / fs + PROBE_PADDING)
+            stream.stop()
+            recording, _, _, capture_start = stream.get_audio_data()
+        finally:
+            stream.close()
+        # Capture timestamps already account for input latency
+        self.reported_latency = (0., start_time - request_time)
+        return np.ravel(recording), capture_start - request_time
+
+
+class SoundDeviceLoopback(object):
+    """
+    Loopback through a live audio device with sounddevice.
+
+    The device's output must be routed back into its input, either with a
+    cable or with a virtual loopback driver. The probe is played and recorded
+    through one full-duplex PortAudio stream, whose reported input and output
+    latencies are kept.
+
+    Parameters
+    ----------
+    device : (int or str or None)
+        sounddevice device for both playback and recording
+    """
+    backend = 'sounddevice (PortAudio)'
+
+    def __init__(self, device=None):
+        import sounddevice as sd
+        self._sd = sd
+        self.device = device
+        self.reported_latency = (0., 0.)
+
+    def playrec(self, probe, fs):
+        """
+        Play `probe` and return the simultaneous recording, with the time
+        from requesting playback to its first sample.
+        """
+        recording = np.zeros(probe.size)
+        position = [0]
+        finished = threading.Event()
+
+        def callback(indata, outdata, frames, time_info, status):
+            start = position[0]
+            stop = min(start + frames, probe.size)
+            outdata[:stop - start, 0] = probe[start:stop]
+            outdata[stop - start:] = 0
+            recording[start:stop] = indata[:stop - start, 0]
+            position[0] = stop
+            if stop == probe.size:
+                raise self._sd.CallbackStop
+
+        with self._sd.Stream(samplerate=fs, channels=1, device=self.device,
+                             latency='low', callback=callback,
+                             finished_callback=finished.set) as stream:
+            self.reported_latency = tuple(stream.latency)
+            finished.wait()
+        # Playback and recording start together
+        return recording, 0.
+
+
+class FileLoopback(object):
+    """
+    Stand-in loopback device backed by a prerecorded wav file.
+
+    The file must hold a recording of the probe that starts when playback was
+    requested. No latency is reported for it, so the whole delay counts as
+    unreported output latency.
+
+    Parameters
+    ----------
+    filename : (str)
+        wav file with the recorded probe
+    """
+    backend = 'file'
+    reported_latency = (0., 0.)
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def playrec(self, probe, fs):
+        """Return the prerecorded loopback of `probe`."""
+        rec_fs, recording = read_wav(self.filename)
+        if rec_fs != fs:
+            raise ValueError('Recording sampling rate ({0}) does not match '
+                             'probe ({1}).'.format(rec_fs, fs))
+        return recording[:, 0], 0.
+
+
+def measure_latency(loopback, probe, fs, n_repeats=N_LATENCY_REPEATS):
+    """
+    Measure audio latency through a loopback.
+
+    Onsets are detected the same way in the probe and in the recording, so the
+    detection threshold does not bias the delay. Each repeat is corrected by
+    the latencies reported for the stream that played and recorded it.
+
+    Returns
+    -------
+    round_trip : (float)
+        median delay from requested playback to recorded onset, in seconds
+    output_latency : (float)
+        median round-trip latency minus the reported input latency, in seconds
+    unreported_latency : (float)
+        median round-trip latency minus the reported input and output
+        latencies, in seconds. Backends whose start times already include the
+        reported output latency, such as PTB, only need this correction.
+    """
+    onset = find_onset(probe)
+    delays = []
+    for _ in range(n_repeats):
+        recording, recording_start = loopback.playrec(probe, fs)
+        delay = recording_start + (find_onset(recording) - onset) / fs
+        input_latency, output_latency = loopback.reported_latency
+        delays.append((delay, delay - input_latency,
+                       delay - input_latency - output_latency))
+    round_trip, output_latency, unreported_latency = np.median(delays, axis=0)
+    return float(round_trip), float(output_latency), float(unreported_latency)
+
+
+def calibrate(script_dir, loopback):
+    """
+    Measure latency and clip levels and save this machine's profile.
+
+    Returns the path to the saved profile.
+    """
+    stim_dir = op.join(script_dir, 'stimuli')
+    probe_fs, tone = read_wav(op.join(stim_dir, PROBE_FILE))
+    probe = make_probe(tone, probe_fs)
+    n_repeats = 1 if isinstance(loopback, FileLoopback) else N_LATENCY_REPEATS
+    round_trip, output_latency, unreported_latency = measure_latency(
+        loopback, probe, probe_fs, n_repeats=n_repeats)
+    print('Round-trip latency: {0:.4f}s, output latency: {1:.4f}s, '
+          'unreported output latency: {2:.4f}s'.format(
+              round_trip, output_latency, unreported_latency))
+
+    clips = {}
+    for clip_file in sorted(glob(op.join(stim_dir, 'audio', '*.wav'))):
+        fs, data = read_wav(clip_file)
+        rms, lufs = measure_levels(data, fs)
+        # Keys match the stim_file column of the config files
+        clips[op.relpath(clip_file, stim_dir).replace(os.sep, '/')] = {
+            'rms': float(rms),
+            'lufs': float(lufs),
+        }
+
+    # Attenuate every clip to the loudness of the quietest one, since
+    # PsychoPy volumes cannot exceed 1
+    finite = [c['lufs'] for c in clips.values() if np.isfinite(c['lufs'])]
+    reference_lufs = min(finite) if finite else None
+    for name, clip in clips.items():
+        if reference_lufs is None or not np.isfinite(clip['lufs']):
+            clip['volume'] = 1.
+        else:
+            clip['volume'] = float(10 ** ((reference_lufs - clip['lufs']) / 20))
+        print('{0}: {1:.1f} dBFS RMS, {2:.1f} LUFS, volume {3:.3f}'.format(
+            name, clip['rms'], clip['lufs'], clip['volume']))
+
+    profile = {
+        'hostname': platform.node(),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'latency_backend': loopback.backend,
+        'round_trip_latency': round_trip,
+        # Of the last stream measured
+        'reported_latency': list(loopback.reported_latency),
+        # Added to onsets from backends that only know when playback was
+        # requested (sounddevice, pygame)
+        'output_latency': output_latency,
+        # Added to PTB start times, which already include reported latency
+        'unreported_latency': unreported_latency,
+        'reference_lufs': reference_lufs,
+        'clips': clips,
+    }
+    out_dir = op.join(script_dir, 'calibration')
+    if not op.isdir(out_dir):
+        os.makedirs(out_dir)
+    out_file = op.join(out_dir, '{0}.json'.format(platform.node()))
+    with open(out_file, 'w') as fo:
+        json.dump(profile, fo, sort_keys=True, indent=4)
+    return out_file
+
+
 if __name__ == '__main__':
     # Ensure that relative paths start from the same directory as this script
     try:
@@ -97,6 +469,40 @@ if __name__ == '__main__':
     except AttributeError:
         script_dir = op.dirname(op.abspath(__file__))
 
+    parser = argparse.ArgumentParser(description='Check or calibrate audio.')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='Measure latency and levels instead of checking '
+                             'volume with a participant.')
+    parser.add_argument('--backend', choices=['ptb', 'sounddevice'],
+                        default='ptb',
+                        help='Library to measure latency through. PTB, the '
+                             "task's preferred audio library, is measured "
+                             "with the task's latency class.")
+    parser.add_argument('--device', default=None,
+                        help='Loopback audio device (index, or name for '
+                             'sounddevice).')
+    parser.add_argument('--loopback-file', default=None,
+                        help='Prerecorded loopback of the probe to use instead '
+                             'of a live device.')
+    args = parser.parse_args()
+
+    if args.calibrate:
+        if args.loopback_file:
+            loopback = FileLoopback(args.loopback_file)
+        else:
+            device = args.device
+            if device is not None and device.isdigit():
+                device = int(device)
+            if args.backend == 'ptb':
+                loopback = PTBLoopback(
+                    device,
+                    latency_class=int(psychopy.prefs.hardware['audioLatencyMode']))
+            else:
+                loopback = SoundDeviceLoopback(device)
+        profile_file = calibrate(script_dir, loopback)
+        print('Calibration profile saved to {0}'.format(profile_file))
+        sys.exit(0)
+
     window = visual.Window(
         fullscr=False,
         size=(800, 600),
@@ -13,6 +13,21 @@ events_description = {
                         'to last button press within duration of trial and '
                         'following fixation.'),
         'Units': '[s] second'
+    },
+    'visual_onset': {
+        'LongName': 'Visual onset',
+        'Description': ('Measured time of the first window flip showing the '
+                        'stimulus, relative to the first trigger.'),
+        'Units': '[s] second'
+    },
+    'audio_onset': {
+        'LongName': 'Audio onset',
+        'Description': ('Measured start time of audio playback, relative to '
+                        'the first trigger. Audio is scheduled to start on '
+                        'the same flip as the first visual frame. If the '
+                        'audio backend cannot schedule playback, this is '
+                        'when playback was requested on that flip.'),
+        'Units': '[s] second'
     }
 }
 
@@ -26,14 +41,20 @@ bold_det_description = {
     'TaskName': 'M1/V1/A1 localization'
 }
 
-with open('task-localizerEstimation_events.json', 'w') as fo:
-    json.dump(events_description, fo, sort_keys=True, indent=4)
+TASK_DESCRIPTIONS = {
+    'localizerEstimation': {'events': events_description,
+                            'bold': bold_est_description},
+    'localizerDetection': {'events': events_description,
+                           'bold': bold_det_description},
+}
+
 
-with open('task-localizerDetection_events.json', 'w') as fo:
-    json.dump(events_description, fo, sort_keys=True, indent=4)
+def main():
+    for task, descriptions in TASK_DESCRIPTIONS.items():
+        for suffix, description in descriptions.items():
+            with open('task-{0}_{1}.json'.format(task, suffix), 'w') as fo:
+                json.dump(description, fo, sort_keys=True, indent=4)
 
-with open('task-localizerEstimation_bold.json', 'w') as fo:
-    json.dump(bold_est_description, fo, sort_keys=True, indent=4)
 
-with open('task-localizerDetection_bold.json', 'w') as fo:
-    json.dump(bold_det_description, fo, sort_keys=True, indent=4)
+if __name__ == '__main__':
+    main()
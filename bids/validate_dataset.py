@@ -0,0 +1,301 @@
+"""
+Write per-run BIDS sidecars and validate events files across a dataset.
+
+Walks a data directory (the task's ``data/`` folder or a BIDS root) for
+``*_events.tsv`` files. For each run, the ``_events.json`` and ``_bold.json``
+sidecars are written from the task templates in
+``generate_task_description_files.py``, keeping any fields already present, and
+the events file is checked for:
+- ``onset``, ``duration``, and ``trial_type`` as the first columns
+- columns that are neither BIDS-standard nor described in the events template
+- missing values written as anything other than ``n/a``
+- non-numeric values in numeric columns and unknown trial types
+- onsets that do not strictly increase
+- a last trial that does not end the task's final ITI, give or take drift,
+  before ``RUN_DURATION``; the limits are the task's own, from ``timing.py``,
+  and ``--end-tolerance`` overrides the longest allowed gap
+
+Runs are processed in a process pool as they are found. Runs whose events file,
+sidecars, and templates have not changed since the last pass are not reprocessed;
+their previous results are read from a cache file in the data directory.
+
+Usage: python validate_dataset.py [data_dir] [--no-sidecars] [--n-procs N]
+                                  [--end-tolerance SECONDS]
+"""
+
+from __future__ import print_function
+import argparse
+import csv
+import hashlib
+import json
+import os
+import os.path as op
+import re
+import sys
+from multiprocessing import Pool
+
+from generate_task_description_files import TASK_DESCRIPTIONS
+
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+from timing import MAX_DRIFT, RUN_DURATION, SHUFFLE_LIMITS  # noqa: E402
+
+# Constants
+# Shortest and longest time allowed between the end of the last trial and the
+# run end, per task
+END_GAPS = {
+    'localizer' + run_type: [limits['final_iti'][0] - MAX_DRIFT,
+                             limits['final_iti'][1] + MAX_DRIFT]
+    for run_type, limits in SHUFFLE_LIMITS.items()
+}
+TRIAL_TYPES = ['visual', 'visual/auditory', 'motor', 'motor/auditory']
+REQUIRED_COLUMNS = ['onset', 'duration', 'trial_type']
+STANDARD_COLUMNS = REQUIRED_COLUMNS + ['response_time', 'stim_file']
+TEXT_COLUMNS = ['trial_type', 'stim_file']
+MISSING_VALUE = 'n/a'
+BAD_MISSING_VALUES = ['', 'nan', 'NaN', 'NA', 'N/A', 'None', 'null']
+CACHE_FILE = '.validation_cache.json'
+TEMPLATE_HASH = hashlib.sha1(
+    json.dumps(TASK_DESCRIPTIONS, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def find_events_files(data_dir):
+    """Yield events files under a directory, in sorted order per directory."""
+    for root, dirs, files in os.walk(data_dir):
+        dirs.sort()
+        for f in sorted(files):
+            if f.endswith('_events.tsv'):
+                yield op.join(root, f)
+
+
+def sidecar_files(events_file):
+    """Get the events and bold sidecar paths for an events file."""
+    stem = events_file[:-len('_events.tsv')]
+    return stem + '_events.json', stem + '_bold.json'
+
+
+def get_task(events_file):
+    """Get the task label from a BIDS filename."""
+    match = re.search(r'_task-([a-zA-Z0-9]+)_', op.basename(events_file))
+    return match.group(1) if match else None
+
+
+def file_signature(f):
+    """Get the modification time and size of a file, or None if it is missing."""
+    try:
+        stat = os.stat(f)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def get_end_gap(task, end_tolerance=None):
+    """
+    Get the shortest and longest time allowed between the end of a task's last
+    trial and the run end, or None for an unknown task.
+    """
+    if task not in END_GAPS:
+        return None
+    end_gap = list(END_GAPS[task])
+    if end_tolerance is not None:
+        end_gap[1] = end_tolerance
+    return end_gap
+
+
+def run_signature(events_file, write_sidecars, end_gap):
+    """Get a signature that changes if a run's inputs, outputs, or checks change."""
+    return [TEMPLATE_HASH, write_sidecars, end_gap] + [
+        file_signature(f) for f in (events_file,) + sidecar_files(events_file)]
+
+
+def write_sidecar(filename, description):
+    """
+    Write or update a JSON sidecar with a template description.
+
+    Fields already in the file but not in the template are kept. The file is
+    only written if its content changes.
+    """
+    current = {}
+    if op.isfile(filename):
+        with open(filename, 'r') as fo:
+            current = json.load(fo)
+    updated = dict(current)
+    updated.update(description)
+    if updated == current:
+        return False
+    with open(filename, 'w') as fo:
+        json.dump(updated, fo, sort_keys=True, indent=4)
+    return True
+
+
+def validate_events(events_file, described_columns, end_gap):
+    """
+    Check an events file.
+
+    Parameters
+    ----------
+    events_file : (str)
+        tab-separated events file
+    described_columns : (iterable)
+        non-standard columns documented in the events sidecar
+    end_gap : (list)
+        shortest and longest time, in seconds, allowed between the end of the
+        last trial and ``RUN_DURATION``
+
+    Returns
+    -------
+    errors : (list of str)
+        problems found in the file
+    """
+    with open(events_file, 'r', newline='') as fo:
+        rows = list(csv.reader(fo, delimiter='\t'))
+    if not rows:
+        return ['File is empty.']
+    columns, rows = rows[0], rows[1:]
+    errors = []
+
+    if columns[:len(REQUIRED_COLUMNS)] != REQUIRED_COLUMNS:
+        errors.append('First columns must be {0}, not {1}.'.format(
+            REQUIRED_COLUMNS, columns[:len(REQUIRED_COLUMNS)]))
+    unknown = [c for c in columns
+               if c not in STANDARD_COLUMNS and c not in described_columns]
+    if unknown:
+        errors.append('Undescribed columns: {0}.'.format(unknown))
+    if not rows:
+        errors.append('File has no events.')
+        return errors
+
+    numeric = {}
+    for i_row, row in enumerate(rows, start=2):
+        if len(row) != len(columns):
+            errors.append('Line {0}: {1} values for {2} columns.'.format(
+                i_row, len(row), len(columns)))
+            continue
+        for column, value in zip(columns, row):
+            if value in BAD_MISSING_VALUES:
+                errors.append('Line {0}: missing {1} must be "{2}", not '
+                              '"{3}".'.format(i_row, column, MISSING_VALUE, value))
+            elif value == MISSING_VALUE:
+                if column in REQUIRED_COLUMNS:
+                    errors.append('Line {0}: {1} may not be missing.'.format(
+                        i_row, column))
+            elif column == 'trial_type':
+                if value not in TRIAL_TYPES:
+                    errors.append('Line {0}: unknown trial type "{1}".'.format(
+                        i_row, value))
+            elif column not in TEXT_COLUMNS:
+                try:
+                    numeric.setdefault(column, []).append(float(value))
+                except ValueError:
+                    errors.append('Line {0}: {1} value "{2}" is not '
+                                  'numeric.'.format(i_row, column, value))
+    if errors:
+        return errors
+
+    onsets = numeric['onset']
+    durations = numeric['duration']
+    if any(b <= a for a, b in zip(onsets[:-1], onsets[1:])):
+        errors.append('Onsets do not strictly increase.')
+    if any(d < 0 for d in durations):
+        errors.append('Durations must not be negative.')
+    end = onsets[-1] + durations[-1]
+    if not RUN_DURATION - end_gap[1] <= end <= RUN_DURATION - end_gap[0]:
+        errors.append('Last trial ends at {0:.2f}s, not {1:.2f}-{2:.2f}s before '
+                      'the {3}s run end.'.format(end, end_gap[0], end_gap[1],
+                                                 RUN_DURATION))
+    return errors
+
+
+def process_run(args):
+    """Write sidecars for and validate one run. Used by the process pool."""
+    events_file, write_sidecars, end_gap = args
+    task = get_task(events_file)
+    if task not in TASK_DESCRIPTIONS:
+        return events_file, ['Unknown task "{0}".'.format(task)], []
+    descriptions = TASK_DESCRIPTIONS[task]
+
+    written = []
+    if write_sidecars:
+        events_json, bold_json = sidecar_files(events_file)
+        for filename, description in ((events_json, descriptions['events']),
+                                      (bold_json, descriptions['bold'])):
+            if write_sidecar(filename, description):
+                written.append(filename)
+    try:
+        errors = validate_events(events_file, descriptions['events'], end_gap)
+    except (OSError, UnicodeDecodeError, csv.Error) as err:
+        errors = ['Could not read file: {0}'.format(err)]
+    return events_file, errors, written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Write BIDS sidecars and validate events files.')
+    repo_dir = op.dirname(op.dirname(op.abspath(__file__)))
+    parser.add_argument('data_dir', nargs='?', default=op.join(repo_dir, 'data'),
+                        help='Task data directory or BIDS root.')
+    parser.add_argument('--no-sidecars', action='store_true',
+                        help='Only validate events files.')
+    parser.add_argument('--n-procs', type=int, default=None,
+                        help='Number of worker processes.')
+    parser.add_argument('--end-tolerance', type=float, default=None,
+                        help='Longest time in seconds allowed between the end '
+                             'of the last trial and the run end. Defaults to '
+                             "the task's longest final ITI plus drift.")
+    args = parser.parse_args(argv)
+    if not op.isdir(args.data_dir):
+        parser.error('{0} is not a directory.'.format(args.data_dir))
+
+    cache_file = op.join(args.data_dir, CACHE_FILE)
+    cache = {}
+    if op.isfile(cache_file):
+        with open(cache_file, 'r') as fo:
+            cache = json.load(fo)
+    write_sidecars = not args.no_sidecars
+
+    results = {}
+
+    def to_process():
+        # Report unchanged runs from the cache and stream the rest to the pool
+        for events_file in find_events_files(args.data_dir):
+            key = op.relpath(events_file, args.data_dir)
+            cached = cache.get(key)
+            end_gap = get_end_gap(get_task(events_file), args.end_tolerance)
+            signature = run_signature(events_file, write_sidecars, end_gap)
+            if cached and cached['signature'] == signature:
+                results[key] = cached
+            else:
+                yield events_file, write_sidecars, end_gap
+
+    n_processed = 0
+    pool = Pool(args.n_procs)
+    try:
+        for events_file, errors, written in pool.imap_unordered(
+                process_run, to_process(), chunksize=16):
+            n_processed += 1
+            for f in written:
+                print('Wrote {0}'.format(f))
+            key = op.relpath(events_file, args.data_dir)
+            end_gap = get_end_gap(get_task(events_file), args.end_tolerance)
+            signature = run_signature(events_file, write_sidecars, end_gap)
+            results[key] = {'signature': signature, 'errors': errors}
+    finally:
+        pool.close()
+        pool.join()
+
+    n_invalid = 0
+    for key in sorted(results):
+        if results[key]['errors']:
+            n_invalid += 1
+            print(key)
+            for error in results[key]['errors']:
+                print('    {0}'.format(error))
+    print('{0} runs checked ({1} unchanged), {2} with errors.'.format(
+        len(results), len(results) - n_processed, n_invalid))
+
+    with open(cache_file, 'w') as fo:
+        json.dump(results, fo, sort_keys=True, indent=1)
+    return 1 if n_invalid else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,42 +11,223 @@ tapping.
 Originally created by Jakub Kaczmarzyk and adapted to combine tasks.
 """
 
+import atexit
+import logging as std_logging
 import os
+import platform
 import sys
 import time
-from glob import glob
 
 import numpy as np
 import pandas as pd
 
+import ringlog
+import run_package
+import run_setup
+from run_setup import TRIAL_DICT, get_base_name, load_calibration, select_config
+from timing import LEAD_IN_DURATION, MAX_DRIFT, RUN_DURATION
+
 import psychopy
 from psychopy import core, event, gui, visual, sound, logging
-from psychopy.constants import STARTED, STOPPED  # pylint: disable=E0401
 from psychopy_visionscience.radial import RadialStim
 
 psychopy.prefs.general["audioLib"] = ["PTB", "sounddevice", "pygame"]
 # psychopy.prefs.general['audioDevice'] = ['Built-in Output']
 
 # Constants
-TRIAL_DICT = {
-    1: "visual",
-    2: "visual/auditory",
-    3: "motor",
-    4: "motor/auditory",
-}
-RUN_DURATION = 450  # time for trials in task
-LEAD_IN_DURATION = 6  # fixation before trials
 END_SCREEN_DURATION = 2
+MAX_AV_ASYNCHRONY = 0.01  # largest tolerated gap between audio and visual onsets
 
 
-def close_on_esc(win):
-    """Close window if escape is pressed."""
-    if "escape" in event.getKeys():
-        win.close()
-        core.quit()
+class PsychoPyLogHandler(std_logging.Handler):
+    """Forward standard library log records to the PsychoPy log."""
+
+    def emit(self, record):
+        if record.levelno >= std_logging.WARNING:
+            level = logging.WARNING
+        else:
+            level = logging.EXP
+        logging.log(self.format(record), level)
+
+
+def quit_task(win):
+    """Close the window and quit."""
+    win.close()
+    core.quit()
+
+
+class TrialOnsets(object):
+    """Stimulus onsets of one trial.
+
+    `visual` is the flip timestamp set by `win.timeOnFlip`, on PsychoPy's
+    logging clock. `audio` is the scheduled or requested audio onset in
+    absolute (`core.getTime`) time. Both are None until they are recorded.
+    """
+
+    def __init__(self):
+        self.visual = None
+        self.audio = None
+
+    def get_visual_onset(self, clock):
+        """Get the visual onset in the time base of `clock`, or NaN."""
+        if self.visual is None:
+            return np.nan
+        return (
+            self.visual
+            + logging.defaultClock.getLastResetTime()
+            - clock.getLastResetTime()
+        )
+
+
+def schedule_audio(win, audio, onsets):
+    """Schedule audio playback to start on the next window flip.
+
+    With the PTB backend, playback is scheduled for the predicted flip time.
+    Other backends start the sound from a flip callback, which records when
+    playback was requested.
+
+    Parameters
+    ----------
+    win : (visual.Window)
+        window whose next flip shows the first stimulus frame
+    audio : (sound.Sound)
+        sound to play
+    onsets : (TrialOnsets)
+        onsets of the trial, whose `audio` onset is set
+    """
+    if sound.audioLib == "ptb":
+        onsets.audio = win.getFutureFlipTime(clock="ptb")
+        audio.play(when=onsets.audio)
+    else:
+        win.callOnFlip(play_now, audio, onsets)
+
+
+def play_now(audio, onsets):
+    """Start a sound and record when playback was requested."""
+    onsets.audio = core.getTime()
+    audio.play()
+
+
+def get_onset_correction(calibration):
+    """Get the calibrated latency to add to audio onsets from this backend.
+
+    PTB start times already include the output latency reported by the
+    driver, so only the unreported remainder is added. Other backends only
+    record when playback was requested, so the full output latency is added.
+
+    Parameters
+    ----------
+    calibration : (dict)
+        calibration profile from `load_calibration`
+
+    Returns
+    -------
+    latency : (numeric)
+        seconds to add to audio onsets
+    """
+    if sound.audioLib == "ptb":
+        return calibration.get("unreported_latency", 0.0)
+    return calibration.get("output_latency", 0.0)
+
+
+def get_audio_onset(audio, clock, onsets, latency=0.0):
+    """Get the measured onset of a playing sound in the time base of `clock`.
+
+    Parameters
+    ----------
+    audio : (sound.Sound)
+        sound that has been started with `schedule_audio`
+    clock : (core.Clock)
+        clock in which to express the onset
+    onsets : (TrialOnsets)
+        onsets of the trial, whose scheduled or requested `audio` onset is
+        used if the backend does not report the actual start time
+    latency : (numeric)
+        calibrated latency to add to the onset, from `get_onset_correction`
+
+    Returns
+    -------
+    onset : (numeric)
+        onset in seconds, or NaN if it could not be determined
+    """
+    try:
+        start = audio.track.status["StartTime"]
+    except (AttributeError, KeyError, TypeError):
+        start = onsets.audio
+    if not start:
+        return np.nan
+    # core.getTime runs on Psychtoolbox time when the PTB backend is in use
+    return start - clock.getLastResetTime() + latency
+
+
+class ResponseBuffer(object):
+    """Collect key press times for a whole run in a preallocated buffer.
+
+    The keyboard is polled once per frame for both the response keys and
+    escape, which quits the task.
+
+    Parameters
+    ----------
+    win : (visual.Window)
+        window to close if escape is pressed
+    clock : (core.Clock)
+        clock used to timestamp key presses
+    keys : (iterable)
+        response keys to collect
+    capacity : (int)
+        maximum number of key presses per run; later presses are dropped
+    log : (ringlog.RingLogger or None)
+        structured logger for key presses
+    """
+
+    def __init__(self, win, clock, keys=("1", "2"), capacity=8192, log=None):
+        self.win = win
+        self.clock = clock
+        self.log = log
+        self.n = 0
+        self.dropped = 0
+        self._key_list = list(keys) + ["escape"]
+        self.times = np.zeros(capacity)
+
+    def clear(self):
+        """Discard buffered presses and pending keyboard events."""
+        self.n = 0
+        event.clearEvents(eventType="keyboard")
+
+    def poll(self):
+        """Poll the keyboard once and buffer any response key presses."""
+        pressed = event.getKeys(keyList=self._key_list, timeStamped=self.clock)
+        if not pressed:
+            return
+        for key, t in pressed:
+            if key == "escape":
+                quit_task(self.win)
+            if self.n == self.times.size:
+                self.dropped += 1
+                continue
+            self.times[self.n] = t
+            self.n += 1
+            if self.log is not None:
+                self.log.log(ringlog.EVENT_CODES["key"], value=t, aux=int(key))
+
+
+def log_frame(log, frame, cost):
+    """Log a flip and the CPU time spent preparing its frame.
+
+    Parameters
+    ----------
+    log : (ringlog.RingLogger or None)
+        structured logger; nothing is logged if None
+    frame : (int)
+        frame number within the current drawing routine
+    cost : (numeric)
+        seconds spent drawing and polling before the flip
+    """
+    if log is not None:
+        log.log(ringlog.EVENT_CODES["flip"], value=cost, aux=frame)
 
 
-def flash_stimuli(win, stimuli, duration, frequency=1):
+def flash_stimuli(win, stimuli, duration, responses, frequency=1, log=None):
     """Flash stimuli.
 
     Parameters
@@ -57,44 +238,35 @@ def flash_stimuli(win, stimuli, duration, frequency=1):
         some iterable of objects with `.draw()` method
     duration : (numeric)
         duration of flashing in seconds
+    responses : (ResponseBuffer)
+        buffer collecting key presses for the run
     frequency : (numeric)
         frequency of flashing in Hertz
+    log : (ringlog.RingLogger or None)
+        structured logger for flips
     """
-    start_time = time.time()
-    duration_one_display = 1 / frequency
+    start_time = time.perf_counter()
+    # Skip a flip that would end more than half a frame after `duration`
+    stop_time = duration - win.monitorFramePeriod / 2
     n_stim = len(stimuli)
-    counter = 0
-    response = event.BuilderKeyResponse()
-    response.tStart = start_time
-    response.frameNStart = 0
-    response.status = STARTED
-    win.callOnFlip(response.clock.reset)
-    event.clearEvents(eventType="keyboard")
-    while time.time() - start_time < duration:
-        keys = event.getKeys(keyList=["1", "2"], timeStamped=trial_clock)
-        if keys:
-            response.keys.extend(keys)
-            response.rt.append(response.clock.getTime())
-        _this_start = time.time()
-        while time.time() - _this_start < duration_one_display:
-            this_stim = stimuli[counter % n_stim]
-            win.flip()
-            keys = event.getKeys(keyList=["1", "2"], timeStamped=trial_clock)
-            if keys:
-                response.keys.extend(keys)
-                response.rt.append(response.clock.getTime())
-            this_stim.draw()
-
-            close_on_esc(win)
-        counter += 1
-    response.status = STOPPED
-    return response.keys, response.rt
+    frame = 0
+    elapsed = 0
+    while elapsed < stop_time:
+        this_stim = stimuli[int(elapsed * frequency) % n_stim]
+        frame_start = time.perf_counter()
+        # Draw before flipping so the first flip shows the first stimulus
+        this_stim.draw()
+        responses.poll()
+        cost = time.perf_counter() - frame_start
+        win.flip()
+        log_frame(log, frame, cost)
+        frame += 1
+        elapsed = time.perf_counter() - start_time
 
 
 def draw_until_keypress(win, stim, continueKeys=["5"]):
     """Draw a stimulus until a specific key is pressed."""
-    response = event.BuilderKeyResponse()
-    win.callOnFlip(response.clock.reset)
+    key_list = continueKeys + ["escape"]
     event.clearEvents(eventType="keyboard")
     while True:
         if isinstance(stim, list):
@@ -102,14 +274,15 @@ def draw_until_keypress(win, stim, continueKeys=["5"]):
                 s.draw()
         else:
             stim.draw()
-        keys = event.getKeys(keyList=continueKeys)
-        if any([ck in keys for ck in continueKeys]):
+        keys = event.getKeys(keyList=key_list)
+        if "escape" in keys:
+            quit_task(win)
+        if keys:
             return
-        close_on_esc(win)
         win.flip()
 
 
-def draw(win, stim, duration, clock):
+def draw(win, stim, duration, responses, log=None):
     """Draw stimulus for a given duration.
 
     Parameters
@@ -118,25 +291,24 @@ def draw(win, stim, duration, clock):
     stim : object with `.draw()` method
     duration : (numeric)
         duration in seconds to display the stimulus
+    responses : (ResponseBuffer)
+        buffer collecting key presses for the run
+    log : (ringlog.RingLogger or None)
+        structured logger for flips
     """
     # Use a busy loop instead of sleeping so we can exit early if need be.
-    start_time = time.time()
-    response = event.BuilderKeyResponse()
-    response.tStart = start_time
-    response.frameNStart = 0
-    response.status = STARTED
-    win.callOnFlip(response.clock.reset)
-    event.clearEvents(eventType="keyboard")
-    while time.time() - start_time < duration:
+    start_time = time.perf_counter()
+    # Skip a flip that would end more than half a frame after `duration`
+    stop_time = duration - win.monitorFramePeriod / 2
+    frame = 0
+    while time.perf_counter() - start_time < stop_time:
+        frame_start = time.perf_counter()
         stim.draw()
-        keys = event.getKeys(keyList=["1", "2"], timeStamped=clock)
-        if keys:
-            response.keys.extend(keys)
-            response.rt.append(response.clock.getTime())
-        close_on_esc(win)
+        responses.poll()
+        cost = time.perf_counter() - frame_start
         win.flip()
-    response.status = STOPPED
-    return response.keys, response.rt
+        log_frame(log, frame, cost)
+        frame += 1
 
 
 class Checkerboard(object):
@@ -196,15 +368,22 @@ if __name__ == "__main__":
     except AttributeError:
         script_dir = os.path.dirname(os.path.abspath(__file__))
 
+    # A prebuilt run package, if given, replaces config selection and setup
+    package_file = sys.argv[1] if len(sys.argv) > 1 else None
+    package = run_package.read_package(package_file) if package_file else None
+
     # Collect user input
     # ------------------
     # Remember to turn fullscr to True for the real deal.
-    exp_info = {
-        "Subject": "",
-        "Session": "",
-        "Run Type": ["Estimation", "Detection"],
-        "Run Number": "",
-    }
+    if package is not None:
+        exp_info = {"Run": package.run_labels}
+    else:
+        exp_info = {
+            "Subject": "",
+            "Session": "",
+            "Run Type": ["Estimation", "Detection"],
+            "Run Number": "",
+        }
     dlg = gui.DlgFromDict(
         dictionary=exp_info,
         title="Localization task",
@@ -227,27 +406,40 @@ if __name__ == "__main__":
     if not os.path.isdir(os.path.join(script_dir, "data")):
         os.makedirs(os.path.join(script_dir, "data"))
 
-    base_name = (
-        f"sub-{exp_info['Subject'].zfill(2)}_"
-        f"ses-{exp_info['Session'].zfill(2)}_"
-        f"task-localizer{exp_info['Run Type']}_"
-        f"run-{exp_info['Run Number'].zfill(2)}"
-    )
-    filename = os.path.join(script_dir, f"data/{base_name}_events")
+    if package is not None:
+        run = package.get_run(exp_info["Run"])
+        exp_info["Run Type"] = run["run_type"]
+        base_name = run["base_name"]
+        filename = os.path.join(script_dir, run["filename"])
+    else:
+        base_name = get_base_name(
+            exp_info["Subject"],
+            exp_info["Session"],
+            exp_info["Run Type"],
+            exp_info["Run Number"],
+        )
+        filename = os.path.join(script_dir, f"data/{base_name}_events")
     logfile = logging.LogFile(filename + ".log", level=logging.EXP)
     logging.console.setLevel(logging.WARNING)  # this outputs to the screen, not a file
-
-    # Get config
-    config_files = glob(
-        os.path.join(script_dir, f"config/config_{exp_info['Run Type']}_*.tsv")
-    )
-    config_file = np.random.choice(config_files, size=1)[0]
-    config_df = pd.read_table(config_file)
-    # Shuffle timing. Trial types and stimuli are already nicely balanced.
-    columns_to_shuffle = ["duration", "iti"]
-    for c in columns_to_shuffle:
-        shuffle_idx = np.random.permutation(config_df.index.values)
-        config_df[c] = config_df.loc[shuffle_idx, c].reset_index(drop=True)
+    # Messages from run setup go to the same log
+    setup_logger = std_logging.getLogger(run_setup.__name__)
+    setup_logger.setLevel(std_logging.INFO)
+    setup_logger.addHandler(PsychoPyLogHandler())
+    setup_logger.propagate = False
+
+    # Get config, with timing shuffled before the trigger arrives
+    if package is not None:
+        if package.header["hostname"] != platform.node():
+            logging.warning(
+                f"Run package was built on {package.header['hostname']}, "
+                f"not {platform.node()}"
+            )
+        logging.exp(f"Using run package {package_file}")
+        config_file = os.path.join(script_dir, run["config_file"])
+        config_df = run["schedule"]
+    else:
+        config_file, config_df = select_config(script_dir, exp_info["Run Type"])
+    logging.exp(f"Using config file {config_file}")
 
     # Check for existence of output files
     outfile = filename + ".tsv"
@@ -258,11 +450,21 @@ if __name__ == "__main__":
     # ------------------
     # Checkerboards
     checkerboards = (Checkerboard(window), Checkerboard(window, inverted=True))
-    # Tones
-    audio_files = sorted(config_df["stim_file"].dropna().unique())
+    # Tones, with levels corrected by this machine's calibration profile
+    if package is not None:
+        calibration = package.header["calibration"]
+        audio_files = package.header["audio_files"]
+    else:
+        calibration = load_calibration(script_dir)
+        audio_files = sorted(config_df["stim_file"].dropna().unique())
     audio_stimuli = [
-        sound.Sound(os.path.join(script_dir, "stimuli", tf)) for tf in audio_files
+        sound.Sound(
+            os.path.join(script_dir, "stimuli", tf),
+            volume=calibration["clips"].get(tf, {}).get("volume", 1.0),
+        )
+        for tf in audio_files
     ]
+    onset_correction = get_onset_correction(calibration)
     # Finger tapping instructions
     tapping = visual.TextStim(
         win=window,
@@ -325,10 +527,24 @@ if __name__ == "__main__":
 
     # Scanner runtime
     # ---------------
+    # Structured log of flips, key presses, and onsets, written off the render
+    # thread and timed by the routine clock
+    routine_clock = core.Clock()
+    event_log = ringlog.RingLogger(
+        os.path.join(script_dir, f"data/{base_name}_ringlog.bin"),
+        clock=routine_clock,
+    )
+    event_log.start()
+    atexit.register(event_log.close)  # also flush on escape
+
     # Wait for trigger from scanner.
     draw_until_keypress(win=window, stim=waiting)
-    routine_clock = core.Clock()
+    routine_clock.reset()
+    event_log.log(ringlog.EVENT_CODES["run_start"])
     trial_clock = core.Clock()
+    # One response buffer for the whole run, polled once per frame
+    responses = ResponseBuffer(window, clock=trial_clock, log=event_log)
+    responses.clear()
     COLUMNS = [
         "onset",
         "duration",
@@ -337,74 +553,149 @@ if __name__ == "__main__":
         "tap_count",
         "tap_duration",
         "stim_file",
+        "visual_onset",
+        "audio_onset",
     ]
     data_set = {c: [] for c in COLUMNS}
 
+    # Routines last until their planned end on the routine clock, so time
+    # overshooting one routine is taken from the next instead of accumulating
+    planned_time = LEAD_IN_DURATION
+
     # Start with six seconds of rest
-    draw(win=window, stim=crosshair, duration=LEAD_IN_DURATION, clock=trial_clock)
+    draw(
+        win=window,
+        stim=crosshair,
+        duration=planned_time - routine_clock.getTime(),
+        responses=responses,
+        log=event_log,
+    )
 
+    trial_codes = {v: k for k, v in TRIAL_DICT.items()}
     c = 0  # trial counter
     for trial_num in config_df.index:
+        # Collect presses from the last frame before the trial starts, so they
+        # are timed and counted with the previous trial
+        responses.poll()
         trial_clock.reset()
         trial_type = config_df.loc[trial_num, "trial_type"]
         trial_duration = config_df.loc[trial_num, "duration"]
         iti_duration = config_df.loc[trial_num, "iti"]
         data_set["onset"].append(routine_clock.getTime())
         data_set["trial_type"].append(trial_type)
-        task_keys = []
-        iti_keys = []
+        event_log.log(
+            ringlog.EVENT_CODES["trial_start"],
+            trial=trial_num,
+            aux=trial_codes[trial_type],
+        )
+        first_response = responses.n
+        # Record the first stimulus flip of the trial
+        onsets = TrialOnsets()
+        window.timeOnFlip(onsets, "visual")
         if "auditory" in trial_type:
             stim_file = config_df.loc[trial_num, "stim_file"]
-            # audio
+            # audio, started on the same flip as the first stimulus frame
             audio_number = audio_files.index(stim_file)
-            audio_stimuli[audio_number].play()
+            schedule_audio(window, audio_stimuli[audio_number], onsets)
 
+        planned_time += trial_duration
         if "visual" in trial_type:
             # flashing checkerboard
-            task_keys, _ = flash_stimuli(
-                window, checkerboards, duration=trial_duration, frequency=5
+            flash_stimuli(
+                window,
+                checkerboards,
+                duration=planned_time - routine_clock.getTime(),
+                responses=responses,
+                frequency=5,
+                log=event_log,
             )
         elif "motor" in trial_type:
             # finger tapping
-            task_keys, _ = draw(
-                win=window, stim=tapping, duration=trial_duration, clock=trial_clock
+            draw(
+                win=window,
+                stim=tapping,
+                duration=planned_time - routine_clock.getTime(),
+                responses=responses,
+                log=event_log,
             )
         else:
             raise Exception()
 
+        data_set["visual_onset"].append(onsets.get_visual_onset(routine_clock))
+        event_log.log(
+            ringlog.EVENT_CODES["visual_onset"],
+            value=data_set["visual_onset"][-1],
+            trial=trial_num,
+        )
         if "auditory" in trial_type:
+            audio_onset = get_audio_onset(
+                audio_stimuli[audio_number],
+                routine_clock,
+                onsets,
+                latency=onset_correction,
+            )
             audio_stimuli[audio_number].stop()
             c += 1
             data_set["stim_file"].append(stim_file)
+            data_set["audio_onset"].append(audio_onset)
+
+            av_asynchrony = audio_onset - data_set["visual_onset"][-1]
+            event_log.log(
+                ringlog.EVENT_CODES["audio_onset"], value=audio_onset, trial=trial_num
+            )
+            event_log.log(
+                ringlog.EVENT_CODES["av_asynchrony"],
+                value=av_asynchrony,
+                trial=trial_num,
+            )
+            logging.exp(
+                f"Trial {trial_num}: audio-visual asynchrony {av_asynchrony:.4f}s"
+            )
+            if not np.abs(av_asynchrony) <= MAX_AV_ASYNCHRONY:
+                logging.warning(
+                    f"Trial {trial_num}: audio-visual asynchrony of "
+                    f"{av_asynchrony:.4f}s exceeds {MAX_AV_ASYNCHRONY}s"
+                )
         else:
             data_set["stim_file"].append("n/a")
+            data_set["audio_onset"].append(np.nan)
 
         data_set["duration"].append(trial_clock.getTime())
+        event_log.log(
+            ringlog.EVENT_CODES["trial_end"],
+            value=data_set["duration"][-1],
+            trial=trial_num,
+        )
 
         # Rest
-        # For last trial, update fixation
+        # The last ITI ends the run, absorbing any drift from the schedule
         if trial_num == config_df.index.values[-1]:
-            iti_duration = RUN_DURATION - routine_clock.getTime()
+            drift = routine_clock.getTime() - planned_time
+            if abs(drift) > MAX_DRIFT:
+                logging.warning(
+                    f"Final ITI starts {drift:.3f}s off its planned onset of "
+                    f"{planned_time:.2f}s"
+                )
+            planned_time = RUN_DURATION
+        else:
+            planned_time += iti_duration
 
-        iti_keys, _ = draw(
+        draw(
             win=window,
             stim=crosshair,
-            duration=iti_duration,
-            clock=trial_clock,
+            duration=planned_time - routine_clock.getTime(),
+            responses=responses,
+            log=event_log,
         )
-        if task_keys and iti_keys:
-            data_set["response_time"].append(task_keys[0][1])
-            data_set["tap_duration"].append(iti_keys[-1][1] - task_keys[0][1])
-        elif task_keys and not iti_keys:
-            data_set["response_time"].append(task_keys[0][1])
-            data_set["tap_duration"].append(task_keys[-1][1] - task_keys[0][1])
-        elif iti_keys and not task_keys:
-            data_set["response_time"].append(iti_keys[0][1])
-            data_set["tap_duration"].append(iti_keys[-1][1] - iti_keys[0][1])
+        # Presses during the trial and the following fixation
+        tap_times = responses.times[first_response : responses.n]
+        if tap_times.size:
+            data_set["response_time"].append(tap_times[0])
+            data_set["tap_duration"].append(tap_times[-1] - tap_times[0])
         else:
             data_set["response_time"].append(np.nan)
             data_set["tap_duration"].append(np.nan)
-        data_set["tap_count"].append((len(task_keys) + len(iti_keys)))
+        data_set["tap_count"].append(tap_times.size)
 
         # Save updated output file
         out_frame = pd.DataFrame(data_set, columns=COLUMNS)
@@ -413,10 +704,11 @@ if __name__ == "__main__":
             sep="\t",
             na_rep="n/a",
             index=False,
-            float_format="%.2f",
+            float_format="%.4f",
         )
 
     print(f"Total run duration: {routine_clock.getTime()}")
+    event_log.log(ringlog.EVENT_CODES["run_end"])
 
     # Compile file
     out_frame = pd.DataFrame(data_set, columns=COLUMNS)
@@ -425,13 +717,28 @@ if __name__ == "__main__":
         sep="\t",
         na_rep="n/a",
         index=False,
-        float_format="%.2f",
+        float_format="%.4f",
     )
 
     # Scanner is off for this
-    draw(win=window, stim=end_screen, duration=END_SCREEN_DURATION, clock=trial_clock)
+    draw(
+        win=window,
+        stim=end_screen,
+        duration=END_SCREEN_DURATION,
+        responses=responses,
+    )
     window.flip()
 
+    event_log.close()
+    if responses.dropped:
+        logging.warning(
+            f"Response buffer overflowed; {responses.dropped} key presses dropped"
+        )
+    if event_log.dropped:
+        logging.warning(
+            f"Ring log buffer overflowed; {event_log.dropped} records dropped"
+        )
+    ringlog.to_text(event_log.filename)
     logging.flush()
 
     # make sure everything is closed down
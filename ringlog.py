@@ -0,0 +1,193 @@
+"""Structured experiment logging through a preallocated ring buffer.
+
+Records are fixed-size binary structs written into a preallocated buffer by
+the render thread, so logging a record costs the same regardless of how many
+records a run produces. A background thread drains the buffer into a compact
+binary file, which `to_text` (or running this module) converts to a TSV file.
+"""
+
+import json
+import sys
+import threading
+import time
+
+import numpy as np
+
+# One record: timestamp, event code, trial number, float value, integer value
+RECORD_DTYPE = np.dtype(
+    [
+        ("time", "<f8"),
+        ("value", "<f8"),
+        ("code", "<u2"),
+        ("trial", "<i2"),
+        ("aux", "<i4"),
+    ]
+)
+EVENT_CODES = {
+    "run_start": 1,
+    "run_end": 2,
+    "trial_start": 3,
+    "trial_end": 4,
+    "flip": 5,
+    "key": 6,
+    "visual_onset": 7,
+    "audio_onset": 8,
+    "av_asynchrony": 9,
+}
+MAGIC = b"RINGLOG1"
+DEFAULT_CAPACITY = 2**16  # records, about 1.5 MB
+DRAIN_INTERVAL = 0.1  # seconds between background writes
+
+
+class RingLogger(object):
+    """Log fixed-size records without blocking the render thread.
+
+    Parameters
+    ----------
+    filename : (str)
+        binary file to write records to
+    clock : (object or None)
+        object with a `getTime()` method used to timestamp records; defaults
+        to `time.perf_counter`
+    capacity : (int)
+        number of records the ring buffer holds before new records are dropped
+    drain_interval : (numeric)
+        seconds between background writes
+    """
+
+    def __init__(
+        self,
+        filename,
+        clock=None,
+        capacity=DEFAULT_CAPACITY,
+        drain_interval=DRAIN_INTERVAL,
+    ):
+        self.filename = filename
+        self.capacity = capacity
+        self.drain_interval = drain_interval
+        self.dropped = 0
+        self._get_time = clock.getTime if clock is not None else time.perf_counter
+        self._buffer = np.zeros(capacity, dtype=RECORD_DTYPE)
+        # Monotonic counters; only the render thread advances the head and only
+        # the writer thread advances the tail.
+        self._head = 0
+        self._tail = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._fo = None
+
+    def start(self):
+        """Open the output file and start the background writer."""
+        self._fo = open(self.filename, "wb")
+        header = json.dumps({"dtype": RECORD_DTYPE.descr, "codes": EVENT_CODES})
+        self._fo.write(MAGIC + header.encode("utf-8") + b"\n")
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def log(self, code, value=0.0, trial=-1, aux=0, t=None):
+        """Add a record to the buffer.
+
+        Parameters
+        ----------
+        code : (int)
+            event code, from `EVENT_CODES`
+        value : (numeric)
+            event value, such as an onset or duration in seconds
+        trial : (int)
+            trial number, or -1 outside of trials
+        aux : (int)
+            integer payload, such as a frame number or key
+        t : (numeric or None)
+            timestamp; defaults to the logger's clock
+        """
+        head = self._head
+        if head - self._tail >= self.capacity:
+            self.dropped += 1
+            return
+        if t is None:
+            t = self._get_time()
+        self._buffer[head % self.capacity] = (t, value, code, trial, aux)
+        self._head = head + 1
+
+    def _drain(self):
+        """Write all buffered records to the file."""
+        head = self._head
+        n_records = head - self._tail
+        if not n_records:
+            return
+        start = self._tail % self.capacity
+        stop = start + n_records
+        if stop <= self.capacity:
+            self._fo.write(self._buffer[start:stop].tobytes())
+        else:
+            self._fo.write(self._buffer[start:].tobytes())
+            self._fo.write(self._buffer[: stop - self.capacity].tobytes())
+        self._tail = head
+
+    def _run(self):
+        while not self._stop.wait(self.drain_interval):
+            self._drain()
+
+    def close(self):
+        """Stop the background writer and write any remaining records."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._drain()
+        self._fo.close()
+
+
+def read(filename):
+    """Read a ring log file.
+
+    Returns
+    -------
+    records : (np.ndarray)
+        structured array of records
+    codes : (dict)
+        mapping of event names to codes used in the file
+    """
+    with open(filename, "rb") as fo:
+        if fo.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filename} is not a ring log file.")
+        header = json.loads(fo.readline().decode("utf-8"))
+        dtype = np.dtype([tuple(field) for field in header["dtype"]])
+        records = np.frombuffer(fo.read(), dtype=dtype)
+    return records, header["codes"]
+
+
+def to_text(filename, out_file=None):
+    """Convert a ring log file to a tab-separated text file.
+
+    Parameters
+    ----------
+    filename : (str)
+        ring log file
+    out_file : (str or None)
+        output file; defaults to `filename` with a `.tsv` extension
+
+    Returns
+    -------
+    out_file : (str)
+        the written file
+    """
+    if out_file is None:
+        out_file = filename.rsplit(".", 1)[0] + ".tsv"
+    records, codes = read(filename)
+    names = {code: name for name, code in codes.items()}
+    with open(out_file, "w") as fo:
+        fo.write("time\tevent\ttrial\tvalue\taux\n")
+        for rec in records:
+            trial = rec["trial"] if rec["trial"] >= 0 else "n/a"
+            fo.write(
+                f"{rec['time']:.6f}\t{names.get(int(rec['code']), rec['code'])}\t"
+                f"{trial}\t{rec['value']:.6f}\t{rec['aux']}\n"
+            )
+    return out_file
+
+
+if __name__ == "__main__":
+    for log_file in sys.argv[1:]:
+        print(to_text(log_file))
@@ -0,0 +1,266 @@
+"""Prebuilt run packages for launching the localizer task without setup.
+
+A package holds every run of one subject's session: the shuffled schedule,
+references to the audio stimuli, output filenames, and this machine's audio
+calibration. The schedule is stored as fixed-size records after a JSON header,
+so `read_package` only memory-maps it. Paths are stored relative to the task
+directory, so a package works from any copy of the task on the machine.
+Runs are numbered separately for each run type, as BIDS run indices are.
+
+Build a package on the stimulus computer ahead of the scan::
+
+    python run_package.py --subject 1 --session 1 --runs Detection Estimation
+
+and launch the task with it::
+
+    python localizer_task.py packages/sub-01_ses-01_runs.pkg
+"""
+
+import argparse
+import json
+import os
+import platform
+import struct
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from run_setup import TRIAL_DICT, get_base_name, load_calibration, select_config
+
+# One record per trial
+RECORD_DTYPE = np.dtype(
+    [
+        ("duration", "<f8"),
+        ("iti", "<f8"),
+        ("run", "<u2"),  # index of the run within the session
+        ("audio", "<i2"),  # index into the package's audio files, -1 for none
+        ("trial_type", "<u1"),  # index into the package's trial types
+    ]
+)
+MAGIC = b"LOCPKG01"
+ALIGNMENT = 64  # records start on a multiple of this many bytes
+
+
+class RunPackage(object):
+    """A memory-mapped run package.
+
+    Parameters
+    ----------
+    header : (dict)
+        package metadata
+    records : (np.ndarray)
+        trial records for all runs
+    """
+
+    def __init__(self, header, records):
+        self.header = header
+        self.records = records
+
+    @property
+    def run_labels(self):
+        """Labels of the runs in the package, in session order."""
+        return [get_run_label(run) for run in self.header["runs"]]
+
+    def get_run(self, label):
+        """Get a run's metadata and schedule.
+
+        Parameters
+        ----------
+        label : (str)
+            run label, from `run_labels`
+
+        Returns
+        -------
+        run : (dict)
+            run metadata from the header, with the schedule as a DataFrame
+            under `schedule`
+        """
+        for run in self.header["runs"]:
+            if get_run_label(run) == label:
+                break
+        else:
+            raise ValueError(f"{label} is not in the package.")
+
+        records = self.records[run["start"] : run["stop"]]
+        audio_files = np.array(self.header["audio_files"] + [None], dtype=object)
+        run = dict(run)
+        run["schedule"] = pd.DataFrame(
+            {
+                "duration": records["duration"],
+                "iti": records["iti"],
+                "trial_type": np.array(self.header["trial_types"], dtype=object)[
+                    records["trial_type"]
+                ],
+                "stim_file": audio_files[records["audio"]],
+            }
+        )
+        return run
+
+
+def get_run_label(run):
+    """Get the label of a run, such as "Detection run 1"."""
+    return f"{run['run_type']} run {run['run_number']}"
+
+
+def write_package(filename, header, records):
+    """Write a run package.
+
+    Parameters
+    ----------
+    filename : (str)
+        output file
+    header : (dict)
+        package metadata
+    records : (np.ndarray)
+        trial records with `RECORD_DTYPE`
+    """
+    header = dict(header, dtype=RECORD_DTYPE.descr, n_records=len(records))
+    header_bytes = json.dumps(header).encode("utf-8")
+    offset = len(MAGIC) + 8 + len(header_bytes)
+    padding = -offset % ALIGNMENT
+    with open(filename, "wb") as fo:
+        fo.write(MAGIC)
+        fo.write(struct.pack("<Q", len(header_bytes) + padding))
+        fo.write(header_bytes + b" " * padding)
+        fo.write(np.ascontiguousarray(records, dtype=RECORD_DTYPE).tobytes())
+
+
+def read_package(filename):
+    """Memory-map a run package.
+
+    Parameters
+    ----------
+    filename : (str)
+        package file
+
+    Returns
+    -------
+    package : (RunPackage)
+    """
+    with open(filename, "rb") as fo:
+        if fo.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filename} is not a run package.")
+        (header_size,) = struct.unpack("<Q", fo.read(8))
+        header = json.loads(fo.read(header_size).decode("utf-8"))
+    dtype = np.dtype([tuple(field) for field in header["dtype"]])
+    records = np.memmap(
+        filename,
+        dtype=dtype,
+        mode="r",
+        offset=len(MAGIC) + 8 + header_size,
+        shape=(header["n_records"],),
+    )
+    return RunPackage(header, records)
+
+
+def build_package(script_dir, subject, session, run_types):
+    """Schedule every run of a session.
+
+    Parameters
+    ----------
+    script_dir : (str)
+        directory containing the task
+    subject, session : (str)
+        subject and session labels
+    run_types : (list of str)
+        run type of each run, in order; runs are numbered per run type
+
+    Returns
+    -------
+    header : (dict)
+        package metadata
+    records : (np.ndarray)
+        trial records for all runs
+    """
+    trial_types = [TRIAL_DICT[k] for k in sorted(TRIAL_DICT)]
+    runs, schedules = [], []
+    run_counts = {}
+    start = 0
+    for run_type in run_types:
+        run_counts[run_type] = run_counts.get(run_type, 0) + 1
+        run_number = run_counts[run_type]
+        config_file, config_df = select_config(script_dir, run_type)
+        base_name = get_base_name(subject, session, run_type, str(run_number))
+        runs.append(
+            {
+                "run_number": run_number,
+                "run_type": run_type,
+                "base_name": base_name,
+                # Relative to the task directory
+                "filename": f"data/{base_name}_events",
+                "config_file": os.path.relpath(config_file, script_dir).replace(
+                    os.sep, "/"
+                ),
+                "start": start,
+                "stop": start + len(config_df),
+            }
+        )
+        schedules.append(config_df)
+        start += len(config_df)
+
+    audio_files = sorted(
+        set().union(*[set(df["stim_file"].dropna()) for df in schedules])
+    )
+    records = np.zeros(start, dtype=RECORD_DTYPE)
+    for i_run, (run, config_df) in enumerate(zip(runs, schedules)):
+        run_records = records[run["start"] : run["stop"]]
+        run_records["run"] = i_run
+        run_records["duration"] = config_df["duration"].to_numpy()
+        run_records["iti"] = config_df["iti"].to_numpy()
+        run_records["trial_type"] = [
+            trial_types.index(tt) for tt in config_df["trial_type"]
+        ]
+        run_records["audio"] = [
+            audio_files.index(f) if isinstance(f, str) else -1
+            for f in config_df["stim_file"]
+        ]
+
+    calibration = load_calibration(script_dir)
+    header = {
+        "hostname": platform.node(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "subject": subject,
+        "session": session,
+        "trial_types": trial_types,
+        "audio_files": audio_files,  # relative to the stimuli directory
+        "calibration": {
+            "latency_backend": calibration.get("latency_backend"),
+            "output_latency": calibration.get("output_latency", 0.0),
+            "unreported_latency": calibration.get("unreported_latency", 0.0),
+            "clips": {
+                f: {"volume": calibration["clips"].get(f, {}).get("volume", 1.0)}
+                for f in audio_files
+            },
+        },
+        "runs": runs,
+    }
+    return header, records
+
+
+if __name__ == "__main__":
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(
+        description="Prebuild the runs of a session for the localizer task."
+    )
+    parser.add_argument("--subject", required=True)
+    parser.add_argument("--session", required=True)
+    parser.add_argument(
+        "--runs",
+        nargs="+",
+        required=True,
+        choices=["Estimation", "Detection"],
+        help="Run type of each run, in order.",
+    )
+    args = parser.parse_args()
+
+    header, records = build_package(script_dir, args.subject, args.session, args.runs)
+    out_dir = os.path.join(script_dir, "packages")
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    out_file = os.path.join(
+        out_dir,
+        f"sub-{args.subject.zfill(2)}_ses-{args.session.zfill(2)}_runs.pkg",
+    )
+    write_package(out_file, header, records)
+    print(f"Wrote {len(header['runs'])} runs to {out_file}")
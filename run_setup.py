@@ -0,0 +1,102 @@
+"""Run setup for the localizer task that does not need PsychoPy.
+
+Selects and shuffles a run's config file, names its outputs, and loads this
+machine's audio calibration, so that runs can be prepared offline by
+`run_package.py` as well as at launch by `localizer_task.py`. Messages are
+logged through the standard `logging` module under this module's name;
+`localizer_task.py` forwards them to the PsychoPy log.
+"""
+
+import json
+import logging
+import os
+import platform
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+from timing import SHUFFLE_LIMITS, shuffle_timing
+
+TRIAL_DICT = {
+    1: "visual",
+    2: "visual/auditory",
+    3: "motor",
+    4: "motor/auditory",
+}
+
+logger = logging.getLogger(__name__)
+
+
+def select_config(script_dir, run_type):
+    """Select a config file at random and shuffle its timing.
+
+    Trial types and stimuli are already nicely balanced, so only timing is
+    shuffled. Config files whose timing cannot be shuffled within
+    `SHUFFLE_LIMITS` are skipped.
+
+    Parameters
+    ----------
+    script_dir : (str)
+        directory containing the `config` folder
+    run_type : (str)
+        "Estimation" or "Detection"
+
+    Returns
+    -------
+    config_file : (str)
+        selected config file
+    config_df : (pd.DataFrame)
+        config with shuffled timing
+    """
+    config_files = glob(os.path.join(script_dir, f"config/config_{run_type}_*.tsv"))
+    for config_file in np.random.permutation(config_files):
+        try:
+            config_df = shuffle_timing(
+                pd.read_table(config_file), **SHUFFLE_LIMITS[run_type]
+            )
+        except ValueError as err:
+            logger.warning(f"Skipping {config_file}: {err}")
+            continue
+        return config_file, config_df
+    raise ValueError("No config file could be shuffled within timing limits.")
+
+
+def get_base_name(subject, session, run_type, run_number):
+    """Get the BIDS base name for a run."""
+    return (
+        f"sub-{subject.zfill(2)}_"
+        f"ses-{session.zfill(2)}_"
+        f"task-localizer{run_type}_"
+        f"run-{run_number.zfill(2)}"
+    )
+
+
+def load_calibration(script_dir):
+    """Load this machine's audio calibration profile.
+
+    Profiles are written by `audio_check.py --calibrate`. If there is none for
+    this machine, no latency or level correction is applied.
+
+    Parameters
+    ----------
+    script_dir : (str)
+        directory containing the `calibration` folder
+
+    Returns
+    -------
+    profile : (dict)
+        calibration profile with `output_latency`, `unreported_latency`, and
+        per-clip `clips` entries
+    """
+    profile_file = os.path.join(script_dir, "calibration", f"{platform.node()}.json")
+    if not os.path.isfile(profile_file):
+        logger.warning(
+            f"No audio calibration profile found at {profile_file}. "
+            "Audio onsets and levels are uncorrected."
+        )
+        return {"output_latency": 0.0, "unreported_latency": 0.0, "clips": {}}
+    with open(profile_file, "r") as fo:
+        profile = json.load(fo)
+    logger.info(f"Using audio calibration profile {profile_file}")
+    return profile
@@ -11,10 +11,24 @@ Originally created by Jakub Kaczmarzyk and adapted to combine tasks.
 
 from __future__ import division, print_function
 import os.path as op
+import sys
 import numpy as np
 import pandas as pd
 from scipy.stats import gumbel_r
 
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+from timing import (  # noqa: E402
+    BLOCK_ITI_DUR,
+    BLOCK_TRIAL_DUR,
+    DUR_RANGE,
+    ITI_RANGE,
+    MAX_MISSING_TIME,
+    N_BLOCKS,
+    SHUFFLE_LIMITS,
+    TASK_TIME,
+    shuffle_timing,
+)
+
 # These tracks come from freepd.com and were converted from mp3 to wav
 # Some files have been shortened to reduce low-volume intros
 _AUDIO_FILES = [
@@ -34,22 +48,16 @@ _AUDIO_FILES = [
     'audio/Ukulele_Song.wav']
 
 # General constants
-TOTAL_DURATION = 450
-TASK_TIME = 438  # time for trials in task
-LEAD_IN_DURATION = 6  # fixation before trials
+# Timing ranges are shared with the task through timing.py
 CONDITIONS = ['visual', 'visual/auditory', 'motor', 'motor/auditory']
 N_CONDS = len(CONDITIONS)  # audio, checkerboard, tapping
 
 # Detection task constants
-N_BLOCKS_PER_COND = 4  # for each condition, for detection task
-BLOCK_TRIAL_DUR = 14
-BLOCK_ITI_DUR = 14
+N_BLOCKS_PER_COND = N_BLOCKS // N_CONDS  # for each condition, for detection task
 
 # Estimation task constants
 N_TRIALS_PER_COND = 15  # for each condition, for estimation task
 N_TRIALS_TOTAL = N_TRIALS_PER_COND * N_CONDS
-DUR_RANGE = (0.5, 4)  # avg of 3s
-ITI_RANGE = (2, 8)  # max determined to minimize difference from TASK_TIME
 
 
 def randomize_carefully(elems, n_repeat=2):
@@ -98,15 +106,15 @@ def determine_estimation_timing(seed=None):
     mu = 4  # mean of 4s
     raw_itis = gumbel_r.rvs(size=100000, loc=mu, scale=1)
     possible_itis = np.round(raw_itis, 1)
-    # crop to 2-8s
-    possible_itis = possible_itis[possible_itis >= 2]
-    possible_itis = possible_itis[possible_itis <= 8]
+    # crop to ITI_RANGE
+    possible_itis = possible_itis[possible_itis >= ITI_RANGE[0]]
+    possible_itis = possible_itis[possible_itis <= ITI_RANGE[1]]
 
     missing_time = np.finfo(dtype='float64').max
     if not seed:
         seed = np.random.randint(1000, 9999)
 
-    while (not np.isclose(missing_time, 0.0, atol=10)) or (missing_time < 0):
+    while not 0 <= missing_time <= MAX_MISSING_TIME:
         state = np.random.RandomState(seed=seed)
         durations = state.uniform(DUR_RANGE[0], DUR_RANGE[1], N_TRIALS_TOTAL)
         durations = np.round(durations, 1)
@@ -152,6 +160,17 @@ def determine_timing(ttype, seed=None):
     return timing_df, seed
 
 
+def can_shuffle(timing_df, ttype):
+    """
+    Check that the task can shuffle a config's timing within its limits.
+    """
+    try:
+        shuffle_timing(timing_df, **SHUFFLE_LIMITS[ttype])
+    except ValueError:
+        return False
+    return True
+
+
 def main():
     n_files = 100
     ttypes = ['Detection', 'Estimation']
@@ -160,6 +179,9 @@ def main():
     for i_file in range(1, n_files+1):
         for ttype in ttypes:
             df, seed = determine_timing(ttype, seed=seed)
+            # Only write files the task can shuffle within its timing limits
+            while not can_shuffle(df, ttype):
+                df, seed = determine_timing(ttype, seed=seed)
             df.to_csv(op.join(out_dir, 'config_{0}_{1:05d}.tsv'.format(ttype, i_file)),
                       sep='\t', index=False, float_format='%.1f')
 
@@ -0,0 +1,172 @@
+"""Run timing for the localizer task.
+
+Holds the timing ranges shared with `task_preparation/generate_config_files.py`
+and shuffles the trial durations and ITIs of a config file within limits on the
+stretched final ITI and on each trial plus its ITI. The generator only writes
+config files that can be shuffled within these limits.
+
+Run this module to check that every config file in `config/` can be shuffled
+within the limits.
+"""
+
+import os
+import sys
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+RUN_DURATION = 450  # time for trials in task
+LEAD_IN_DURATION = 6  # fixation before trials
+N_SHUFFLE_CANDIDATES = 100  # timing permutations drawn per config file
+TIMING_TOLERANCE = 1e-6  # rounding slack when comparing summed durations
+# Seconds the run may drift from its schedule before the final ITI. Routines
+# end within half a frame of their planned end, so this allows a few frames.
+MAX_DRIFT = 0.05
+
+# Detection task
+N_BLOCKS = 16
+BLOCK_TRIAL_DUR = 14
+BLOCK_ITI_DUR = 14
+
+# Estimation task
+DUR_RANGE = (0.5, 4)  # avg of 3s
+ITI_RANGE = (2, 8)  # max determined to minimize difference from TASK_TIME
+TASK_TIME = 438  # time for trials in task
+MAX_MISSING_TIME = 4  # generated trials may fall this far short of TASK_TIME
+MAX_FINAL_ITI = 14
+TRIAL_PERIOD_RANGE = (4, 10)  # seconds from one trial onset to the next
+
+# Time left over after the trials, which is added to the final ITI
+_DETECTION_SLACK = (
+    RUN_DURATION - LEAD_IN_DURATION - N_BLOCKS * (BLOCK_TRIAL_DUR + BLOCK_ITI_DUR)
+)
+_ESTIMATION_SLACK = RUN_DURATION - LEAD_IN_DURATION - TASK_TIME
+# (min, max) seconds for the stretched final ITI and for each trial plus its ITI
+SHUFFLE_LIMITS = {
+    "Detection": {
+        "final_iti": (BLOCK_ITI_DUR + _DETECTION_SLACK,) * 2,
+        "trial_period": (BLOCK_TRIAL_DUR + BLOCK_ITI_DUR,) * 2,
+    },
+    "Estimation": {
+        "final_iti": (ITI_RANGE[0] + _ESTIMATION_SLACK, MAX_FINAL_ITI),
+        "trial_period": TRIAL_PERIOD_RANGE,
+    },
+}
+
+
+def shuffle_timing(
+    config_df, final_iti, trial_period, n_candidates=N_SHUFFLE_CANDIDATES
+):
+    """Shuffle trial durations and ITIs within timing limits.
+
+    Durations are permuted freely. ITIs are then placed one trial at a time,
+    each drawn at random from the ITIs left that keep that trial within the
+    limits. The final ITI is placed first, since the time left over after the
+    trials, which it absorbs, fixes which ITIs can go last. The other trials
+    are placed in random order so that no position gets the leftover ITIs.
+    Candidate permutations are built all at once and the first one in which
+    every trial could be placed is kept.
+
+    Parameters
+    ----------
+    config_df : (pd.DataFrame)
+        config with `duration` and `iti` columns
+    final_iti : (tuple)
+        minimum and maximum duration of the stretched final ITI, in seconds
+    trial_period : (tuple)
+        minimum and maximum of each trial's duration plus its ITI, excluding
+        the final trial, in seconds
+    n_candidates : (int)
+        number of candidate permutations to build
+
+    Returns
+    -------
+    shuffled_df : (pd.DataFrame)
+        config with shuffled timing, with the planned final ITI in the last row
+
+    Raises
+    ------
+    ValueError
+        if no candidate permutation satisfies the limits
+    """
+    durations = config_df["duration"].to_numpy()
+    itis = config_df["iti"].to_numpy()
+    n_trials = durations.size
+    slack = RUN_DURATION - LEAD_IN_DURATION - durations.sum() - itis.sum()
+    rows = np.arange(n_candidates)
+
+    # One candidate permutation per row
+    duration_idx = np.argsort(np.random.random((n_candidates, n_trials)), axis=1)
+    candidate_durations = durations[duration_idx]
+    iti_idx = np.zeros((n_candidates, n_trials), dtype=int)
+    available = np.ones((n_candidates, n_trials), dtype=bool)
+    valid = np.ones(n_candidates, dtype=bool)
+
+    def place(position, min_iti, max_iti):
+        # Draw an ITI for one position of every candidate from those allowed
+        allowed = (
+            available
+            & (itis >= np.reshape(min_iti, (-1, 1)) - TIMING_TOLERANCE)
+            & (itis <= np.reshape(max_iti, (-1, 1)) + TIMING_TOLERANCE)
+        )
+        valid[:] &= allowed.any(axis=1)
+        choice = np.argmax(np.random.random(allowed.shape) * allowed, axis=1)
+        iti_idx[rows, position] = choice
+        available[rows, choice] = False
+
+    place(n_trials - 1, final_iti[0] - slack, final_iti[1] - slack)
+    order = np.argsort(np.random.random((n_candidates, n_trials - 1)), axis=1)
+    for position in order.T:
+        trial_durations = candidate_durations[rows, position]
+        place(
+            position,
+            trial_period[0] - trial_durations,
+            trial_period[1] - trial_durations,
+        )
+    if not valid.any():
+        raise ValueError(
+            f"None of {n_candidates} timing permutations satisfy the limits."
+        )
+
+    # Candidates are already random, so the first valid one is a fair draw
+    choice = np.argmax(valid)
+    shuffled_df = config_df.copy()
+    shuffled_df["duration"] = candidate_durations[choice]
+    shuffled_df["iti"] = itis[iti_idx[choice]]
+    shuffled_df.loc[shuffled_df.index[-1], "iti"] += slack
+    return shuffled_df
+
+
+def check_config_files(config_dir):
+    """Check that every config file can be shuffled within the limits.
+
+    Parameters
+    ----------
+    config_dir : (str)
+        directory containing `config_<run type>_*.tsv` files
+
+    Returns
+    -------
+    failures : (list of str)
+        config files that cannot be shuffled, with the reason
+    """
+    failures = []
+    for run_type, limits in SHUFFLE_LIMITS.items():
+        for config_file in sorted(
+            glob(os.path.join(config_dir, f"config_{run_type}_*.tsv"))
+        ):
+            try:
+                shuffle_timing(pd.read_table(config_file), **limits)
+            except ValueError as err:
+                failures.append(f"{config_file}: {err}")
+    return failures
+
+
+if __name__ == "__main__":
+    config_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config")
+    failures = check_config_files(config_dir)
+    for failure in failures:
+        print(failure)
+    print(f"{len(failures)} config files cannot be shuffled within limits.")
+    sys.exit(1 if failures else 0)